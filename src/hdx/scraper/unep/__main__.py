@@ -6,11 +6,19 @@ script then creates in HDX.
 """
 
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from os.path import expanduser, join
+from shutil import rmtree
 
 from hdx.api.configuration import Configuration
+from hdx.api.locations import Locations
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
 from hdx.data.user import User
 from hdx.facades.infer_arguments import facade
+from hdx.location.country import Country
 from hdx.utilities.downloader import Download
 from hdx.utilities.path import (
     progress_storing_folder,
@@ -20,7 +28,7 @@ from hdx.utilities.path import (
 from hdx.utilities.retriever import Retrieve
 
 from hdx.scraper.unep._version import __version__
-from hdx.scraper.unep.pipeline import Pipeline
+from hdx.scraper.unep.pipeline import Pipeline, process_country
 
 logger = logging.getLogger(__name__)
 
@@ -59,21 +67,59 @@ def main(
             )
             pipeline = Pipeline(configuration, retriever, tempdir)
             layer_id_to_type, countries = pipeline.get_layersinfo()
+        # Countries are generated in forked worker processes, which inherit the
+        # HDX configuration, locations and country data loaded here, and
+        # created in HDX one at a time in country order
+        Locations.validlocations()
+        Country.countriesdata()
+        positions = {country["iso3"]: i for i, country in enumerate(countries)}
+        max_workers = min(configuration["country_workers"], os.cpu_count() or 1)
+        futures = {}
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=get_context("fork")
+        ) as executor:
             for _, country in progress_storing_folder(info, countries, "iso3"):
                 countryiso = country["iso3"]
-                dataset = pipeline.generate_dataset(layer_id_to_type, countryiso)
-                if dataset:
-                    dataset.update_from_yaml(
-                        script_dir_plus_file(
-                            join("config", "hdx_dataset_static.yaml"), main
+                # Keep the workers busy with the countries that come next
+                position = positions[countryiso]
+                for next_country in countries[position : position + 2 * max_workers]:
+                    next_countryiso = next_country["iso3"]
+                    if next_countryiso not in futures:
+                        futures[next_countryiso] = executor.submit(
+                            process_country,
+                            layer_id_to_type,
+                            next_countryiso,
+                            tempdir,
+                            save,
+                            use_saved,
+                            _SAVED_DATA_DIR,
                         )
+                result = futures.pop(countryiso).result()
+                country_folder = join(tempdir, countryiso)
+                if not result:
+                    rmtree(country_folder, ignore_errors=True)
+                    continue
+                dataset_data, resources_data = result
+                dataset = Dataset(dataset_data)
+                resources = []
+                for resource_data, file_to_upload in resources_data:
+                    resource = Resource(resource_data)
+                    if file_to_upload:
+                        resource.set_file_to_upload(file_to_upload)
+                    resources.append(resource)
+                dataset.add_update_resources(resources)
+                dataset.update_from_yaml(
+                    script_dir_plus_file(
+                        join("config", "hdx_dataset_static.yaml"), main
                     )
-                    dataset.create_in_hdx(
-                        remove_additional_resources=True,
-                        match_resource_order=False,
-                        updated_by_script=_UPDATED_BY_SCRIPT,
-                        batch=info["batch"],
-                    )
+                )
+                dataset.create_in_hdx(
+                    remove_additional_resources=True,
+                    match_resource_order=False,
+                    updated_by_script=_UPDATED_BY_SCRIPT,
+                    batch=info["batch"],
+                )
+                rmtree(country_folder, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -3,21 +3,86 @@
 
 import logging
 import os
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+from gzip import GzipFile
 from os.path import basename, join
 from pathlib import Path
+from threading import local
 from urllib.parse import urlencode
 
-from geopandas import read_file
+import orjson
 from geopandas.geodataframe import GeoDataFrame
 from hdx.api.configuration import Configuration
 from hdx.data.dataset import Dataset
 from hdx.data.hdxobject import HDXError
 from hdx.data.resource import Resource
 from hdx.location.country import Country
+from hdx.utilities.downloader import Download
 from hdx.utilities.retriever import Retrieve
+from pandas import NaT, Timestamp, concat
+from pyogrio import read_dataframe, write_dataframe
+from shapely import to_geojson
 
 logger = logging.getLogger(__name__)
 
+_country_name = lru_cache(maxsize=512)(Country.get_country_name_from_iso3)
+
+
+def _json_default(value: object) -> str | None:
+    """
+    Serialise values orjson does not handle natively
+    """
+    if value is NaT:
+        return None
+    if isinstance(value, Timestamp):
+        return value.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def write_geojson(gdf: GeoDataFrame, filepath: str, compress: bool = True) -> None:
+    """
+    Write GeoJSON FeatureCollection, gzipped if compress is True, serialising
+    geometries in one vectorised call and encoding features with orjson
+    """
+    name = Path(filepath).name.removesuffix(".gz").removesuffix(".geojson")
+    header = {"type": "FeatureCollection", "name": name}
+    epsg = gdf.crs.to_epsg() if gdf.crs else None
+    if epsg and epsg != 4326:
+        header["crs"] = {
+            "type": "name",
+            "properties": {"name": f"urn:ogc:def:crs:EPSG::{epsg}"},
+        }
+    geometries = to_geojson(gdf.geometry.values)
+    columns = [column for column in gdf.columns if column != gdf.geometry.name]
+    if columns:
+        properties = gdf[columns].to_dict(orient="records")
+    else:
+        properties = [{}] * len(gdf)
+    if compress:
+        # Fixed mtime so unchanged data gives an unchanged file hash
+        output = GzipFile(filepath, "wb", mtime=0)
+    else:
+        output = open(filepath, "wb")
+    with output:
+        output.write(orjson.dumps(header)[:-1] + b',"features":[\n')
+        for i, (geometry, feature_properties) in enumerate(zip(geometries, properties)):
+            if i:
+                output.write(b",\n")
+            feature = {
+                "type": "Feature",
+                "properties": feature_properties,
+                "geometry": orjson.Fragment(geometry) if geometry else None,
+            }
+            output.write(
+                orjson.dumps(
+                    feature, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY
+                )
+            )
+        output.write(b"\n]}\n")
+
 
 class Pipeline:
     def __init__(self, configuration: Configuration, retriever: Retrieve, tempdir: str):
@@ -27,6 +92,15 @@ class Pipeline:
         self._tempdir = tempdir
         os.environ["OGR_ORGANIZE_POLYGONS"] = "SKIP"
 
+    @contextmanager
+    def thread_retriever(self) -> Iterator[Retrieve]:
+        """
+        Get retriever with its own downloader for use in a worker thread. A
+        Download holds the current response so cannot be shared between threads
+        """
+        with Download() as downloader:
+            yield self._retriever.clone(downloader)
+
     def get_countries(self, layer_url: str) -> set:
         query = {
             "f": "json",
@@ -35,9 +109,9 @@ class Pipeline:
             "outFields": "ISO3",
             "where": "ISO3 LIKE '___'",
         }
-        response = self._retriever.download_json(
-            f"{layer_url}/query?{urlencode(query)}"
-        )
+        # Called from a thread pool in get_layersinfo
+        with self.thread_retriever() as retriever:
+            response = retriever.download_json(f"{layer_url}/query?{urlencode(query)}")
         return {x["attributes"]["iso3"] for x in response["features"]}
 
     def get_layersinfo(self) -> tuple[dict, list]:
@@ -50,7 +124,6 @@ class Pipeline:
         if not layers:
             return {}, []
         layer_id_to_type = {}
-        countries = set()
         for layer in layers:
             if layer["type"] != "Feature Layer":
                 continue
@@ -62,10 +135,19 @@ class Pipeline:
                 layer_type = "polygons"
 
             layer_id_to_type[layer_id] = layer_type
-            countries.update(self.get_countries(f"{self._url}/{layer_id}"))
+        countries = set()
+        layer_urls = [f"{self._url}/{layer_id}" for layer_id in layer_id_to_type]
+        if self._configuration["assume_common_iso3"]:
+            # All layers cover the same countries so querying one is enough
+            layer_urls = layer_urls[:1]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for layer_countries in executor.map(self.get_countries, layer_urls):
+                countries.update(layer_countries)
         return layer_id_to_type, [{"iso3": country} for country in sorted(countries)]
 
-    def get_date_range(self, layer_url: str, countryiso: str) -> tuple[int, int]:
+    def get_date_range(
+        self, layer_url: str, countryiso: str, retriever: Retrieve
+    ) -> tuple[int, int]:
         """
         Get min & max dates using outStatistics from ArcGIS API
         """
@@ -90,7 +172,7 @@ class Pipeline:
             "returnGeometry": "false",
             "where": f"STATUS_YR > 0 AND ISO3='{countryiso}'",
         }
-        stats_response = self._retriever.download_json(
+        stats_response = retriever.download_json(
             f"{layer_url}/query?{urlencode(stats_query)}"
         )
 
@@ -101,9 +183,15 @@ class Pipeline:
         return start_year, end_year
 
     def generate_geojson(
-        self, gdf: GeoDataFrame, base_filename: str, layer_type: str
+        self,
+        gdf: GeoDataFrame,
+        base_filename: str,
+        layer_type: str,
+        compress: bool = True,
     ) -> Resource:
         filename = f"{base_filename}_{layer_type}.geojson"
+        if compress:
+            filename = f"{filename}.gz"
         geojson_resource = Resource(
             {
                 "name": filename,
@@ -112,14 +200,35 @@ class Pipeline:
         )
         geojson_resource.set_format("geojson")
         filepath = join(self._tempdir, filename)
-        gdf.to_file(filepath, driver="GeoJSON")
+        write_geojson(gdf, filepath, compress)
         geojson_resource.set_file_to_upload(filepath)
         return geojson_resource
 
+    def generate_geoparquet(
+        self, gdf: GeoDataFrame, base_filename: str, layer_type: str
+    ) -> Resource:
+        filename = f"{base_filename}_{layer_type}.parquet"
+        geoparquet_resource = Resource(
+            {
+                "name": filename,
+                "description": f"GeoParquet format of the summary of {layer_type}",
+            }
+        )
+        geoparquet_resource.set_format("parquet")
+        filepath = join(self._tempdir, filename)
+        gdf.to_parquet(
+            filepath,
+            compression="zstd",
+            geometry_encoding="WKB",
+            write_covering_bbox=True,
+        )
+        geoparquet_resource.set_file_to_upload(filepath)
+        return geoparquet_resource
+
     def generate_csv(
         self, gdf: GeoDataFrame, base_filename: str, layer_type: str
     ) -> Resource:
-        filename = f"{base_filename}_{layer_type}.csv"
+        filename = f"{base_filename}_{layer_type}.csv.gz"
         csv_resource = Resource(
             {
                 "name": filename,
@@ -128,8 +237,14 @@ class Pipeline:
         )
         csv_resource.set_format("csv")
         filepath = join(self._tempdir, filename)
-        df_attributes = gdf.drop(columns="geometry")
-        df_attributes.to_csv(filepath, index=False)
+        columns = [column for column in gdf.columns if column != gdf.geometry.name]
+        gdf.to_csv(
+            filepath,
+            columns=columns,
+            index=False,
+            lineterminator="\n",
+            compression={"method": "gzip", "mtime": 0},
+        )
         csv_resource.set_file_to_upload(filepath)
         return csv_resource
 
@@ -153,6 +268,153 @@ class Pipeline:
         }
         return Resource(geoservice_resource)
 
+    def _read_features(self, query_url: str, retriever: Retrieve) -> GeoDataFrame:
+        logger.info(f"Querying {query_url}")
+        query_path = retriever.download_file(query_url)
+        return read_dataframe(f"ESRIJSON:{query_path}", use_arrow=True)
+
+    def _read_pages(self, query_urls: list[str]) -> list[GeoDataFrame]:
+        """
+        Read pages concurrently. Each pool thread downloads through its own
+        retriever, reused for all the pages that thread reads
+        """
+        thread_data = local()
+        with ExitStack() as retrievers:
+
+            def read_page(query_url: str) -> GeoDataFrame:
+                retriever = getattr(thread_data, "retriever", None)
+                if retriever is None:
+                    retriever = retrievers.enter_context(self.thread_retriever())
+                    thread_data.retriever = retriever
+                return self._read_features(query_url, retriever)
+
+            max_workers = self._configuration["page_workers"]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                return list(executor.map(read_page, query_urls))
+
+    def _fetch_all_features(
+        self, layer_url: str, where: str, retriever: Retrieve
+    ) -> GeoDataFrame | None:
+        """
+        Get features matching where clause from ArcGIS API. The server caps the
+        number of records per response so pages are requested concurrently.
+        Return features or None if there are none
+        """
+        count_query = {
+            "f": "json",
+            "returnCountOnly": True,
+            "where": where,
+        }
+        count_response = retriever.download_json(
+            f"{layer_url}/query?{urlencode(count_query)}"
+        )
+        count = count_response["count"]
+        if count == 0:
+            return None
+        page_size = self._configuration["page_size"]
+        query = {
+            "f": "json",
+            "orderByFields": "OBJECTID",
+            "outFields": "*",
+            "geometryPrecision": 10,
+            "maxAllowableOffset": 10,
+            "where": where,
+            "resultRecordCount": page_size,
+        }
+        query_urls = [
+            f"{layer_url}/query?{urlencode(query | {'resultOffset': offset})}"
+            for offset in range(0, count, page_size)
+        ]
+        if len(query_urls) == 1:
+            gdf = self._read_features(query_urls[0], retriever)
+        else:
+            gdf = concat(self._read_pages(query_urls), ignore_index=True)
+        # Pages are silently truncated if page_size exceeds the maxRecordCount
+        if len(gdf) != count:
+            raise ValueError(
+                f"Expected {count} features from {layer_url} but got {len(gdf)}!"
+            )
+        return gdf
+
+    def _fetch_layer(
+        self, layer_id: int, countryiso: str
+    ) -> tuple[int, int, GeoDataFrame] | None:
+        """
+        Get data for one layer from ArcGIS API
+        Return start year, end year and features or None if there is no data
+        """
+        layer_url = f"{self._url}/{layer_id}"
+        # Layers run in a thread pool so each needs its own downloader
+        with self.thread_retriever() as retriever:
+            gdf = self._fetch_all_features(layer_url, f"ISO3='{countryiso}'", retriever)
+        if gdf is None:
+            return None
+        # Get min & max dates from the features rather than a separate query
+        status_years = gdf["status_yr"]
+        status_years = status_years[status_years > 0]
+        if status_years.empty:
+            return None
+        start_year = int(status_years.min())
+        end_year = int(status_years.max())
+        # Drop attribute columns that are null or empty for every feature
+        attributes = gdf.drop(columns=gdf.geometry.name)
+        empty = (attributes.isna() | attributes.eq("")).all()
+        gdf = gdf.drop(columns=empty.index[empty])
+        return start_year, end_year, gdf
+
+    def _process_layer(
+        self,
+        layer_id: int,
+        layer_type: str,
+        gdf: GeoDataFrame,
+        base_filename: str,
+        compress_geojson: bool,
+    ) -> list[Resource]:
+        """
+        Create data outputs for one layer
+        Return resources
+        """
+        layer_url = f"{self._url}/{layer_id}"
+        resources = []
+        logger.info(f"Adding GeoJSON data for {layer_type}")
+        # Only GeoJSON is simplified: GPKG and GeoParquet keep full detail
+        simplified = gdf.geometry.simplify(self._configuration["simplify_tolerance"])
+        resources.append(
+            self.generate_geojson(
+                gdf.set_geometry(simplified),
+                base_filename,
+                layer_type,
+                compress_geojson,
+            )
+        )
+        logger.info(f"Adding GeoParquet data for {layer_type}")
+        resources.append(self.generate_geoparquet(gdf, base_filename, layer_type))
+        logger.info(f"Adding csv data for {layer_type}")
+        resources.append(self.generate_csv(gdf, base_filename, layer_type))
+        logger.info(f"Adding GeoService for {layer_type}")
+        resources.append(self.generate_geoservice(layer_url, layer_type))
+        return resources
+
+    def write_gpkg(self, layer_gdfs: dict, gpkg_filepath: str) -> None:
+        """
+        Write layers to a fresh GPKG then move it into place so that a partial
+        file is never left at gpkg_filepath
+        """
+        tmp_filepath = f"{gpkg_filepath.removesuffix('.gpkg')}.tmp.gpkg"
+        Path(tmp_filepath).unlink(missing_ok=True)
+        for i, (layer_type, gdf) in enumerate(layer_gdfs.items()):
+            logger.info(f"Adding GPKG data for {layer_type}")
+            write_dataframe(
+                gdf,
+                tmp_filepath,
+                layer=layer_type,
+                driver="GPKG",
+                append=i > 0,
+                # Distribution file so skip building the R-tree on close
+                SPATIAL_INDEX="NO",
+            )
+        os.replace(tmp_filepath, gpkg_filepath)
+
     def generate_dataset(
         self, layer_id_to_type: dict, countryiso: str
     ) -> Dataset | None:
@@ -161,7 +423,7 @@ class Pipeline:
         Return dataset
         """
         # Dataset info
-        countryname = Country.get_country_name_from_iso3(countryiso)
+        countryname = _country_name(countryiso)
         dataset_name = f"unep_wdpca_{countryiso.lower()}"
         title = f"Protected and Conserved Areas (WDPCA) in {countryname}"
         dataset = Dataset({"name": dataset_name, "title": title})
@@ -171,44 +433,51 @@ class Pipeline:
             logger.error(f"Couldn't find country {countryiso}, skipping")
             return None
         base_filename = self._configuration["base_filename"]
-        gpkg_filepath = join(self._tempdir, f"{base_filename}.gpkg")
-        Path(gpkg_filepath).unlink(missing_ok=True)
         start_years = []
         end_years = []
         resources = []
-        for layer_id, layer_type in layer_id_to_type.items():
-            layer_url = f"{self._url}/{layer_id}"
-            start_year, end_year = self.get_date_range(layer_url, countryiso)
-            if not start_year:
-                continue
-            start_years.append(start_year)
-            end_years.append(end_year)
-            query = {
-                "f": "json",
-                "orderByFields": "OBJECTID",
-                "outFields": "*",
-                "geometryPrecision": 10,
-                "maxAllowableOffset": 10,
-                "where": f"ISO3='{countryiso}'",
-            }
-            query_url = f"{layer_url}/query?{urlencode(query)}"
-            logger.info(f"Querying {query_url}")
-            if self._retriever.save or self._retriever.use_saved:
-                query_url = str(self._retriever.download_file(query_url))
-            gdf = read_file("ESRIJSON:" + query_url)
-            logger.info(f"Adding GPKG data for {layer_type}")
-            gdf.to_file(gpkg_filepath, layer=layer_type, driver="GPKG")
-            logger.info(f"Adding GeoJSON data for {layer_type}")
-            resources.append(self.generate_geojson(gdf, base_filename, layer_type))
-            logger.info(f"Adding csv data for {layer_type}")
-            resources.append(self.generate_csv(gdf, base_filename, layer_type))
-            logger.info(f"Adding GeoService for {layer_type}")
-            resources.append(self.generate_geoservice(layer_url, layer_type))
-
-        if len(start_years) == 0:
-            logger.error(f"No data for {countryiso}, skipping")
-            return None
+        layer_gdfs = {}
+        # Layers are independent and dominated by network and disk I/O
+        with ThreadPoolExecutor(max_workers=max(len(layer_id_to_type), 1)) as executor:
+            futures = [
+                executor.submit(self._fetch_layer, layer_id, countryiso)
+                for layer_id in layer_id_to_type
+            ]
+            for layer_id, future in zip(layer_id_to_type, futures):
+                result = future.result()
+                if result is None:
+                    continue
+                start_year, end_year, gdf = result
+                start_years.append(start_year)
+                end_years.append(end_year)
+                layer_gdfs[layer_id] = gdf
+
+            if len(start_years) == 0:
+                logger.error(f"No data for {countryiso}, skipping")
+                return None
 
+            # HDX cannot preview gzipped GeoJSON so the GeoJSON of the last layer
+            # with data, which is the one previewed, is written uncompressed
+            preview_layer_id = list(layer_gdfs)[-1]
+            futures = [
+                executor.submit(
+                    self._process_layer,
+                    layer_id,
+                    layer_id_to_type[layer_id],
+                    gdf,
+                    base_filename,
+                    layer_id != preview_layer_id,
+                )
+                for layer_id, gdf in layer_gdfs.items()
+            ]
+            for future in futures:
+                resources.extend(future.result())
+
+        gpkg_filepath = join(self._tempdir, f"{base_filename}.gpkg")
+        self.write_gpkg(
+            {layer_id_to_type[layer_id]: gdf for layer_id, gdf in layer_gdfs.items()},
+            gpkg_filepath,
+        )
         resources.insert(0, self.generate_gpkg(gpkg_filepath))
         dataset.preview_off()
         for resource in reversed(resources):
@@ -224,3 +493,44 @@ class Pipeline:
         dataset.set_subnational(True)
 
         return dataset
+
+
+def process_country(
+    layer_id_to_type: dict,
+    countryiso: str,
+    tempdir_root: str,
+    save: bool = False,
+    use_saved: bool = False,
+    saved_dir: str = "saved_data",
+) -> tuple[dict, list[tuple[dict, str | None]]] | None:
+    """
+    Generate dataset for a country in its own folder under tempdir_root so that
+    countries can be run in forked processes, which inherit the HDX
+    configuration. Datasets cannot be pickled so return dataset dictionary and
+    resource dictionaries with files to upload
+    """
+    configuration = Configuration.read()
+    # A forked process must not share its parent's connection to HDX
+    configuration.setup_session_remoteckan()
+    tempdir = join(tempdir_root, countryiso)
+    os.makedirs(tempdir, exist_ok=True)
+    with Download() as downloader:
+        retriever = Retrieve(
+            downloader=downloader,
+            fallback_dir=tempdir,
+            saved_dir=saved_dir,
+            temp_dir=tempdir,
+            save=save,
+            use_saved=use_saved,
+            # saved_dir is shared by all workers and was cleared by the driver
+            delete=False,
+        )
+        pipeline = Pipeline(configuration, retriever, tempdir)
+        dataset = pipeline.generate_dataset(layer_id_to_type, countryiso)
+    if dataset is None:
+        return None
+    resources = [
+        (resource.data, resource.get_file_to_upload())
+        for resource in dataset.get_resources()
+    ]
+    return dataset.data, resources
@@ -1,11 +1,15 @@
-from os.path import join
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import exists, join
+from threading import Thread
 
 import pytest
 from hdx.api.configuration import Configuration
 from hdx.api.locations import Locations
 from hdx.data.vocabulary import Vocabulary
 from hdx.location.country import Country
+from hdx.utilities.path import get_filename_extension_from_url
 from hdx.utilities.useragent import UserAgent
+from slugify import slugify
 
 
 @pytest.fixture(scope="session")
@@ -51,3 +55,39 @@ def configuration(config_dir):
         "name": "approved",
     }
     return Configuration.read()
+
+
+@pytest.fixture
+def featureserver_url(input_dir):
+    """Serve saved responses over HTTP for tests that download"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            filename, _ = get_filename_extension_from_url(
+                self.path, second_last=True, use_query=True
+            )
+            path = join(input_dir, slugify(filename))
+            if not exists(path):
+                path = f"{path}.json"
+            if not exists(path):
+                self.send_error(404)
+                return
+            with open(path, "rb") as input_file:
+                data = input_file.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield (
+        f"http://127.0.0.1:{server.server_port}"
+        "/server/rest/services/ProtectedPlanet/WDPCA/FeatureServer"
+    )
+    server.shutdown()
+    server.server_close()
@@ -1,10 +1,19 @@
-from os.path import join
+import json
+from gzip import GzipFile
+from os import makedirs
+from os.path import exists, join
+from shutil import copy
 
+import pytest
+from geopandas import GeoDataFrame
 from hdx.utilities.downloader import Download
 from hdx.utilities.path import temp_dir
 from hdx.utilities.retriever import Retrieve
+from pandas import Timestamp, to_datetime
+from pyogrio import read_dataframe
+from shapely import Point, box
 
-from hdx.scraper.unep.pipeline import Pipeline
+from hdx.scraper.unep.pipeline import Pipeline, process_country, write_geojson
 
 
 class TestPipeline:
@@ -85,12 +94,17 @@ class TestPipeline:
                     {
                         "description": "GeoJSON format of the summary of points",
                         "format": "geojson",
-                        "name": "protected_conserved_areas_WDPCA_points.geojson",
+                        "name": "protected_conserved_areas_WDPCA_points.geojson.gz",
+                    },
+                    {
+                        "description": "GeoParquet format of the summary of points",
+                        "format": "parquet",
+                        "name": "protected_conserved_areas_WDPCA_points.parquet",
                     },
                     {
                         "description": "CSV format of the summary of points",
                         "format": "csv",
-                        "name": "protected_conserved_areas_WDPCA_points.csv",
+                        "name": "protected_conserved_areas_WDPCA_points.csv.gz",
                     },
                     {
                         "description": "ArcGIS Map Service of the summary of points",
@@ -104,10 +118,15 @@ class TestPipeline:
                         "format": "geojson",
                         "name": "protected_conserved_areas_WDPCA_polygons.geojson",
                     },
+                    {
+                        "description": "GeoParquet format of the summary of polygons",
+                        "format": "parquet",
+                        "name": "protected_conserved_areas_WDPCA_polygons.parquet",
+                    },
                     {
                         "description": "CSV format of the summary of polygons",
                         "format": "csv",
-                        "name": "protected_conserved_areas_WDPCA_polygons.csv",
+                        "name": "protected_conserved_areas_WDPCA_polygons.csv.gz",
                     },
                     {
                         "description": "ArcGIS Map Service of the summary of polygons",
@@ -116,3 +135,181 @@ class TestPipeline:
                         "url": "https://data-gis.unep-wcmc.org/server/rest/services/ProtectedPlanet/WDPCA/FeatureServer/1",
                     },
                 ]
+                # Previewed GeoJSON is left uncompressed so HDX can open it
+                preview_filepath = dataset.get_resources()[5].get_file_to_upload()
+                assert preview_filepath == join(
+                    tempdir, "protected_conserved_areas_WDPCA_polygons.geojson"
+                )
+                assert len(read_dataframe(preview_filepath)) == 156
+
+    def test_fetch_all_features(self, configuration, input_dir, monkeypatch):
+        with temp_dir(
+            "TestUNEPPages",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            with Download(user_agent="test") as downloader:
+                retriever = Retrieve(
+                    downloader=downloader,
+                    fallback_dir=tempdir,
+                    saved_dir=input_dir,
+                    temp_dir=tempdir,
+                    save=False,
+                    use_saved=True,
+                )
+                pipeline = Pipeline(configuration, retriever, tempdir)
+                layer_url = f"{configuration['url']}/0"
+                monkeypatch.setitem(configuration, "page_size", 6)
+                gdf = pipeline._fetch_all_features(layer_url, "ISO3='BOL'", retriever)
+                assert len(gdf) == 11
+                assert gdf["objectid"].tolist() == [
+                    9,
+                    1847,
+                    3757,
+                    4790,
+                    4791,
+                    4792,
+                    4850,
+                    4851,
+                    5389,
+                    5390,
+                    5391,
+                ]
+                # Server returns at most 6 records whatever page size is asked for
+                monkeypatch.setitem(configuration, "page_size", 12)
+                with pytest.raises(ValueError):
+                    pipeline._fetch_all_features(layer_url, "ISO3='BOL'", retriever)
+
+    def test_process_country(self, configuration, input_dir):
+        with temp_dir(
+            "TestUNEPProcessCountry",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            dataset_data, resources = process_country(
+                {0: "points", 1: "polygons"},
+                "BOL",
+                tempdir,
+                use_saved=True,
+                saved_dir=input_dir,
+            )
+            assert dataset_data["name"] == "unep_wdpca_bol"
+            assert dataset_data["dataset_date"] == (
+                "[1939-01-01T00:00:00 TO 2013-12-31T23:59:59]"
+            )
+            assert len(resources) == 9
+            resource_data, file_to_upload = resources[0]
+            assert resource_data["name"] == "protected_conserved_areas_WDPCA.gpkg"
+            assert file_to_upload == join(
+                tempdir, "BOL", "protected_conserved_areas_WDPCA.gpkg"
+            )
+            assert exists(file_to_upload)
+            assert resources[4] == (
+                {
+                    "description": "ArcGIS Map Service of the summary of points",
+                    "format": "GeoService",
+                    "name": "points GeoService",
+                    "url": "https://data-gis.unep-wcmc.org/server/rest/services/ProtectedPlanet/WDPCA/FeatureServer/0",
+                },
+                None,
+            )
+            resource_data, file_to_upload = resources[5]
+            assert resource_data["dataset_preview_enabled"] == "True"
+            assert file_to_upload == join(
+                tempdir, "BOL", "protected_conserved_areas_WDPCA_polygons.geojson"
+            )
+            assert exists(file_to_upload)
+
+    def test_process_country_save(
+        self, configuration, input_dir, featureserver_url, monkeypatch
+    ):
+        monkeypatch.setitem(configuration, "url", featureserver_url)
+        with temp_dir(
+            "TestUNEPProcessCountrySave",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            # The driver saves the layer info before the workers run
+            saved_dir = join(tempdir, "saved_data")
+            layersinfo_filename = "wdpca-featureserver-f-json.json"
+            makedirs(saved_dir, exist_ok=True)
+            copy(join(input_dir, layersinfo_filename), saved_dir)
+            dataset_data, resources = process_country(
+                {0: "points", 1: "polygons"},
+                "BOL",
+                join(tempdir, "output"),
+                save=True,
+                saved_dir=saved_dir,
+            )
+            assert dataset_data["name"] == "unep_wdpca_bol"
+            assert len(resources) == 9
+            assert exists(join(saved_dir, layersinfo_filename))
+            assert exists(
+                join(
+                    saved_dir, "0-query-f-json-returncountonly-true-where-iso3-bol.json"
+                )
+            )
+            assert exists(
+                join(
+                    saved_dir,
+                    "1-query-f-json-orderbyfields-objectid-outfields-"
+                    "geometryprecision-10-maxallowableoffset-10-where-iso3-bol-"
+                    "resultrecordcount-2000-resultoffset-0",
+                )
+            )
+
+    def test_write_geojson(self):
+        with temp_dir(
+            "TestUNEPWriteGeoJSON",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            gdf = GeoDataFrame(
+                {
+                    "name": ["Área A", "B", None],
+                    "rep_area": [1.5, float("nan"), 3.25],
+                    "status_yr": [1939, 0, 2013],
+                    "updated": to_datetime(
+                        ["2020-01-02 03:04:05", None, "2021-05-06 00:00:00"]
+                    ),
+                },
+                geometry=[Point(1, 2), None, box(0, 0, 10, 10)],
+                crs="EPSG:3857",
+            )
+            filepath = join(tempdir, "test.geojson.gz")
+            write_geojson(gdf, filepath)
+            with GzipFile(filepath) as input_file:
+                geojson = json.load(input_file)
+            assert geojson["name"] == "test"
+            assert geojson["crs"] == {
+                "type": "name",
+                "properties": {"name": "urn:ogc:def:crs:EPSG::3857"},
+            }
+            assert geojson["features"][1] == {
+                "type": "Feature",
+                "properties": {
+                    "name": "B",
+                    "rep_area": None,
+                    "status_yr": 0,
+                    "updated": None,
+                },
+                "geometry": None,
+            }
+
+            result = read_dataframe(f"/vsigzip/{filepath}")
+            assert len(result) == 3
+            assert result.crs.to_epsg() == 3857
+            assert result["name"].tolist() == ["Área A", "B", None]
+            assert result["rep_area"].isna().tolist() == [False, True, False]
+            assert result["status_yr"].tolist() == [1939, 0, 2013]
+            assert result["updated"][0] == Timestamp("2020-01-02 03:04:05")
+            assert result["updated"].isna().tolist() == [False, True, False]
+            assert result.geometry.isna().tolist() == [False, True, False]
+            assert result.geometry[0].equals(Point(1, 2))
+            assert result.geometry[2].equals(box(0, 0, 10, 10))
+
+            filepath = join(tempdir, "test.geojson")
+            write_geojson(gdf, filepath, compress=False)
+            with open(filepath, "rb") as input_file:
+                assert json.load(input_file)["name"] == "test"
+            assert len(read_dataframe(filepath)) == 3